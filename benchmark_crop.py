@@ -0,0 +1,198 @@
+"""
+Copyright (C) 2022 Abraham George Smith
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Benchmark registration on the full size scans against registration on
+scans cropped to the body (see crop_images.py).
+
+For each fraction both registrations are computed, the fraction struct is
+transformed to the planning scan with each result and the overlap with the
+planning struct is measured. The registration speedup and the change in
+the overlap metrics are reported.
+"""
+
+import os
+import argparse
+import time
+
+from medpy import metric
+import nibabel as nib
+
+from compute_ants_registrations import register_fraction
+from crop_images import crop_scan_for_registration, get_cropped_file_name
+from transform_image import transform_moving_image_to_fixed_image
+
+
+def load_binary_struct(struct_path):
+    struct = nib.load(struct_path).get_fdata()
+    return struct >= 0.5
+
+
+def get_overlap_metrics(fixed_struct, transformed_struct_path):
+    transformed_struct = load_binary_struct(transformed_struct_path)
+    return (metric.binary.dc(transformed_struct, fixed_struct),
+            metric.binary.hd95(transformed_struct, fixed_struct))
+
+
+def time_registration(fixed_scan_path, moving_scan_path, output_prefix):
+    """ register and return the time taken. Raises if the registration failed """
+    start_time = time.time()
+    exit_status = register_fraction(fixed_scan_path, moving_scan_path, output_prefix)
+    if exit_status != 0 or not os.path.isfile(f'{output_prefix}1Warp.nii.gz'):
+        raise Exception(f'registration of {moving_scan_path} failed (exit status {exit_status})')
+    return time.time() - start_time
+
+
+def get_transformed_overlap(fraction_path, struct_name, planning_dir_name,
+                            planning_scan_path, fixed_struct, prefix):
+    """ transform the struct with the transforms named prefix and return (dice, hd95) """
+    output_path = os.path.join(fraction_path, f'{prefix}_struct.nii.gz')
+    _, exit_status = transform_moving_image_to_fixed_image(fraction_path, struct_name,
+                                                           planning_dir_name,
+                                                           planning_scan_path,
+                                                           transform_prefix=prefix,
+                                                           output_path=output_path)
+    if exit_status != 0:
+        raise Exception(f'transforming {struct_name} in {fraction_path} failed '
+                        f'(exit status {exit_status})')
+    return get_overlap_metrics(fixed_struct, output_path)
+
+
+def benchmark_fraction(patient_path, planning_dir_name, fraction_dir, scan_name,
+                       struct_name, fixed_struct, crop_options):
+    """
+    return (full_time, crop_time, full_metrics, crop_metrics) for one fraction.
+    crop_time includes cropping the fraction scan, but not the planning scan,
+    which is cropped once per patient (see benchmark_patient).
+    """
+    fraction_path = os.path.join(patient_path, fraction_dir)
+    planning_path = os.path.join(patient_path, planning_dir_name)
+
+    full_time = time_registration(os.path.join(planning_path, scan_name),
+                                  os.path.join(fraction_path, scan_name),
+                                  os.path.join(fraction_path, 'benchmark_full'))
+
+    # cropping is part of the cost of the cropped registration.
+    start_time = time.time()
+    cropped_fraction_scan_path = crop_scan_for_registration(fraction_path, scan_name,
+                                                            crop_options)
+    crop_time = time.time() - start_time + time_registration(
+        os.path.join(planning_path, get_cropped_file_name(scan_name)),
+        cropped_fraction_scan_path, os.path.join(fraction_path, 'benchmark_cropped'))
+
+    metrics = [get_transformed_overlap(fraction_path, struct_name, planning_dir_name,
+                                       os.path.join(planning_path, scan_name),
+                                       fixed_struct, prefix)
+               for prefix in ['benchmark_full', 'benchmark_cropped']]
+    return full_time, crop_time, metrics[0], metrics[1]
+
+
+def benchmark_patient(benchmark_file, patient_path, planning_dir_name, scan_name,
+                      struct_name, crop_options):
+    """
+    Benchmark all fractions of the patient, writing a row for each to benchmark_file.
+    Fractions that fail are reported and skipped. Returns the (full, crop) times
+    of each fraction and the time taken to crop the planning scan.
+    """
+    patient = os.path.basename(patient_path)
+    planning_path = os.path.join(patient_path, planning_dir_name)
+    start_time = time.time()
+    crop_scan_for_registration(planning_path, scan_name, crop_options)
+    planning_crop_time = time.time() - start_time
+    fixed_struct = load_binary_struct(os.path.join(planning_path, struct_name))
+
+    times = []
+    for fraction_dir in [d for d in os.listdir(patient_path) if d != planning_dir_name]:
+        try:
+            result = benchmark_fraction(patient_path, planning_dir_name, fraction_dir,
+                                        scan_name, struct_name, fixed_struct, crop_options)
+        except Exception as error:  # pylint: disable=broad-except
+            print(f'{patient},{fraction_dir} skipped: {error}')
+            continue
+        times.append(result[:2])
+        write_fraction_result(benchmark_file, patient, fraction_dir, *result)
+    return times, planning_crop_time
+
+
+def write_fraction_result(benchmark_file, patient, fraction_dir,
+                          full_time, crop_time, full_metrics, crop_metrics):
+    (full_dice, full_hd), (crop_dice, crop_hd) = full_metrics, crop_metrics
+    print(f"{patient},{fraction_dir},speedup:{full_time / crop_time:.2f},"
+          f"dice change:{crop_dice - full_dice},hd95 change:{crop_hd - full_hd}")
+    print(f"{patient},{fraction_dir},{full_time},{crop_time},"
+          f"{full_time / crop_time},{full_dice},{crop_dice},"
+          f"{full_hd},{crop_hd}", file=benchmark_file)
+
+
+def benchmark_crop(in_dir, planning_dir_name, scan_name, struct_name, first_n,
+                   crop_options, output_csv_path):
+    """
+    The per fraction crop_time in the csv excludes cropping the planning scan.
+    The total cropped time (and speedup) printed at the end includes it.
+    """
+    patient_dirs = os.listdir(in_dir)
+    if first_n:
+        patient_dirs = patient_dirs[:first_n]
+
+    full_time = 0
+    crop_time = 0
+    with open(output_csv_path, 'w+', encoding='utf-8') as benchmark_file:
+        print("patient,fraction,full_time,crop_time,speedup,"
+              "full_dice,crop_dice,full_hd95,crop_hd95", file=benchmark_file)
+        for patient in patient_dirs:
+            times, planning_crop_time = benchmark_patient(
+                benchmark_file, os.path.join(in_dir, patient), planning_dir_name,
+                scan_name, struct_name, crop_options)
+            if times:
+                full_time += sum(t[0] for t in times)
+                crop_time += sum(t[1] for t in times) + planning_crop_time
+
+    if crop_time:
+        print(f'total registration time full: {full_time} seconds, '
+              f'cropped (including planning scan crops): {crop_time} seconds, '
+              f'speedup: {full_time / crop_time:.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description="Benchmark registration with and without cropping to the body",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("input", help="Directory containing patient folders (nifty files)")
+    parser.add_argument("plan_dir", help="Name of directory containing the "
+                                         "planning scan (reference image)")
+    parser.add_argument("scan_name", help="Name of the scan files that will be registered,"
+                                          " assumed same for all fractions.")
+    parser.add_argument("struct_name", help="Name of the struct files used to measure overlap,"
+                                            " assumed same for all fractions.")
+    parser.add_argument("--first-n", type=int, required=False,
+                        help="first n, number of patients to process (useful for testing)")
+    parser.add_argument("--crop-threshold", type=float, required=False,
+                        help="Body intensity threshold. Otsu's method is used if not given")
+    parser.add_argument("--crop-margin", type=float, default=10.0,
+                        help="Margin added around the body bounding box in physical units "
+                             "(voxels for scans from convert_dicom_to_nifty.py, "
+                             "which have unit spacing)")
+    parser.add_argument("--shrink-factor", type=int, default=1,
+                        help="Integer downsampling factor applied after cropping")
+    parser.add_argument("--output-csv", type=str, required=True,
+                        help="Path of output csv file")
+    args = parser.parse_args()
+    config = vars(args)
+    print(config)
+    benchmark_crop(config['input'], config['plan_dir'], config['scan_name'],
+                   config['struct_name'], config['first_n'],
+                   {'threshold': config['crop_threshold'],
+                    'margin': config['crop_margin'],
+                    'shrink_factor': config['shrink_factor']},
+                   config['output_csv'])
@@ -16,10 +16,68 @@ import os
 import argparse
 import time
 
-def compute_all_registrations(in_dir, planning_scan_dir_name, scan_name, first_n):
+from crop_images import crop_scan_for_registration
+
+def register_fraction(planning_scan_path, fraction_scan_path, output_path):
+    """
+    Register the fraction (moving image) to the planning scan (fixed image).
+    Transforms are written using output_path as the prefix.
+    Returns the exit status of antsRegistrationSyN.sh
+    """
+    # for documentation on antsRegistrationSyN.sh see:
+    # https://github.com/ANTsX/ANTs/blob/master/Scripts/antsRegistrationSyN.sh 
+
+    # register the fraction (moving image) to the planning scan (fixed image)
+    cmd = (f'antsRegistrationSyN.sh -d 3 '
+           '-t s ' # transform type s:  rigid_affine+deformable syn (3 stages)'
+           f'-n {os.cpu_count()} ' # number of threads to use.
+           f'-f {planning_scan_path} -m {fraction_scan_path} '
+           # The output_path supplied is used as 
+           # the OUTPUTNAME variable in antsRegistrationSyn.sh script, which 
+           # is then used to create the following output argument
+           # for the antsRegistration executable.
+           # [ $OUTPUTNAME,${OUTPUTNAME}Warped.nii.gz,${OUTPUTNAME}InverseWarped.nii.gz ]
+           # This output argument is document as follows, taken from antsRegistration docs:
+           #
+           # -o, --output outputTransformPrefix
+           #     [outputTransformPrefix,<outputWarpedImage>,<outputInverseWarpedImage>]
+           #     Specify the output transform prefix (output format is
+           #     .nii.gz ). Optionally, one can choose to warp the
+           #     moving image to the fixed space and, if the inverse
+           #     transform exists, one can also output the warped fixed
+           #     image. Note that only the images specified in the first
+           #     metric call are warped. Use antsApplyTransforms to warp
+           #     other images using the resultant transform(s). When a
+           #     composite transform is not specified, linear transforms
+           #     are specified with a '.mat' suffix and displacement
+           #     fields with a 'Warp.nii.gz' suffix (and
+           #     'InverseWarp.nii.gz', when applicable. In addition, for
+           #     velocity-based transforms, the full velocity field is
+           #     written to file ('VelocityField.nii.gz') as long as the
+           #     collapse transforms flag is turned off ('-z 0').
+           #
+           # From the above docs we can see that <outputWarpedImage> is the moving image
+           # transformed to the fixed image. Which in our case is the fraction
+           # transformed to the MR SIM.
+           # Concretely, in our case the fraction scan warped to the MR sim will be
+           # named registeredWarped.nii.gz
+           f'-o {output_path}')
+
+    print(cmd)
+    return os.system(cmd)
+
+
+def compute_all_registrations(in_dir, planning_scan_dir_name, scan_name, first_n,
+                              crop_options=None):
     # scan_name is the name of the actual scan file. We assume this is the
     # same for all fractions (and the planning scan), with unique details being stored
     # in the folder names.
+    #
+    # If crop_options (threshold, margin and shrink_factor) are given then the
+    # scans are cropped to the body (and downsampled) before registration, see
+    # crop_images.py. The cropped images keep their position in physical space,
+    # so the resulting transforms can still be applied to the full size dose
+    # and struct with transform_image.py
     patient_dirs = os.listdir(in_dir)
 
     if first_n:
@@ -29,63 +87,28 @@ def compute_all_registrations(in_dir, planning_scan_dir_name, scan_name, first_n
         patient_path = os.path.join(in_dir, patient_dir)
         fraction_dirs = os.listdir(patient_path)
         fraction_dirs = [d for d in fraction_dirs if d != planning_scan_dir_name]
-        
+
+        planning_scan_path = get_scan_for_registration(
+            os.path.join(patient_path, planning_scan_dir_name), scan_name, crop_options)
+
         for fraction_dir in fraction_dirs:
             start_time = time.time()
-            fraction_scan_path = os.path.join(in_dir, patient_dir,
-                                              fraction_dir, scan_name)
-            planning_scan_path = os.path.join(in_dir, patient_dir,
-                                              planning_scan_dir_name,
-                                              scan_name)
+            fraction_scan_path = get_scan_for_registration(
+                os.path.join(patient_path, fraction_dir), scan_name, crop_options)
 
             # output files will be called 'registered' and exist in the fraction directory.
             output_path = os.path.join(in_dir, patient_dir,
                                        fraction_dir, 'registered')
-
-            # for documentation on antsRegistrationSyN.sh see:
-            # https://github.com/ANTsX/ANTs/blob/master/Scripts/antsRegistrationSyN.sh 
-
-            # register the fraction (moving image) to the planning scan (fixed image)
-            cmd = (f'antsRegistrationSyN.sh -d 3 '
-                   '-t s ' # transform type s:  rigid_affine+deformable syn (3 stages)'
-                   f'-n {os.cpu_count()} ' # number of threads to use.
-                   f'-f {planning_scan_path} -m {fraction_scan_path} '
-                   # This output_path supplied (defined above) is used as 
-                   # the OUTPUTNAME variable in antsRegistrationSyn.sh script, which 
-                   # is then used to create the following output argument
-                   # for the antsRegistration executable.
-                   # [ $OUTPUTNAME,${OUTPUTNAME}Warped.nii.gz,${OUTPUTNAME}InverseWarped.nii.gz ]
-                   # This output argument is document as follows, taken from antsRegistration docs:
-                   #
-                   # -o, --output outputTransformPrefix
-                   #     [outputTransformPrefix,<outputWarpedImage>,<outputInverseWarpedImage>]
-                   #     Specify the output transform prefix (output format is
-                   #     .nii.gz ). Optionally, one can choose to warp the
-                   #     moving image to the fixed space and, if the inverse
-                   #     transform exists, one can also output the warped fixed
-                   #     image. Note that only the images specified in the first
-                   #     metric call are warped. Use antsApplyTransforms to warp
-                   #     other images using the resultant transform(s). When a
-                   #     composite transform is not specified, linear transforms
-                   #     are specified with a '.mat' suffix and displacement
-                   #     fields with a 'Warp.nii.gz' suffix (and
-                   #     'InverseWarp.nii.gz', when applicable. In addition, for
-                   #     velocity-based transforms, the full velocity field is
-                   #     written to file ('VelocityField.nii.gz') as long as the
-                   #     collapse transforms flag is turned off ('-z 0').
-                   #
-                   # From the above docs we can see that <outputWarpedImage> is the moving image
-                   # transformed to the fixed image. Which in our case is the fraction
-                   # transformed to the MR SIM.
-                   # Concretely, in our case the fraction scan warped to the MR sim will be
-                   # named registeredWarped.nii.gz
-                   f'-o {output_path}')
-
-            print(cmd)
-            os.system(cmd)
+            register_fraction(planning_scan_path, fraction_scan_path, output_path)
             print(f'time for {fraction_dir},{patient_dir}: {time.time() - start_time} seconds')
 
 
+def get_scan_for_registration(scan_dir, scan_name, crop_options):
+    """ return the path of the scan to register, cropping it first if crop_options are given """
+    if crop_options:
+        return crop_scan_for_registration(scan_dir, scan_name, crop_options)
+    return os.path.join(scan_dir, scan_name)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -99,8 +122,22 @@ if __name__ == '__main__':
                                           " assumed same for all fractions.")
     parser.add_argument("--first-n", type=int, required=False,
                         help="first n, number of patients to process (useful for testing)")
+    parser.add_argument("--crop", action=argparse.BooleanOptionalAction,
+                        help="crop scans to the body before registration")
+    parser.add_argument("--crop-threshold", type=float, required=False,
+                        help="Body intensity threshold. Otsu's method is used if not given")
+    parser.add_argument("--crop-margin", type=float, default=10.0,
+                        help="Margin added around the body bounding box in physical units "
+                             "(voxels for scans from convert_dicom_to_nifty.py, "
+                             "which have unit spacing)")
+    parser.add_argument("--shrink-factor", type=int, default=1,
+                        help="Integer downsampling factor applied after cropping")
     args = parser.parse_args()
     config = vars(args)
     print(config)
     compute_all_registrations(config['input'], config['plan_dir'],
-                              config['scan_name'], config['first_n'])
+                              config['scan_name'], config['first_n'],
+                              {'threshold': config['crop_threshold'],
+                               'margin': config['crop_margin'],
+                               'shrink_factor': config['shrink_factor']}
+                              if config['crop'] else None)
@@ -0,0 +1,241 @@
+"""
+Copyright (C) 2022 Abraham George Smith
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Check that the forward and inverse deformable transforms computed by
+compute_ants_registrations.py actually invert each other.
+
+For each voxel x of the fixed image the forward displacement u is applied
+and the inverse displacement v is interpolated at x + u. The inverse
+consistency error is |u(x) + v(x + u(x))|, which should be close to zero.
+"""
+
+import os
+from multiprocessing import Pool
+import argparse
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from results_store import (get_parameters_key, get_completed_keys, get_missing_fractions,
+                           upsert_results, export_csv)
+
+STAGE = 'inverse_consistency'
+
+
+def trilinear_interpolate(volume, coords):
+    """
+    Interpolate volume (z, y, x, components) at continuous (z, y, x) index
+    coords with shape (..., 3). Coordinates outside the volume are clamped to the edge.
+    """
+    shape = np.array(volume.shape[:3])
+    coords = np.clip(coords, 0, shape - 1)
+    lower = np.minimum(np.floor(coords).astype(np.intp), np.maximum(shape - 2, 0))
+    upper = np.minimum(lower + 1, shape - 1)
+    frac = (coords - lower).astype(np.float32)
+    result = np.zeros(coords.shape[:-1] + volume.shape[3:], dtype=np.float32)
+    for corner in range(8):
+        use_upper = [(corner >> axis) & 1 for axis in range(3)]
+        index = tuple(np.where(u, upper[..., axis], lower[..., axis])
+                      for axis, u in enumerate(use_upper))
+        weight = np.ones(coords.shape[:-1], dtype=np.float32)
+        for axis, u in enumerate(use_upper):
+            weight *= frac[..., axis] if u else 1 - frac[..., axis]
+        result += weight[..., np.newaxis] * volume[index]
+    return result
+
+
+def get_physical_to_index_matrix(image):
+    """ matrix converting a physical displacement (x, y, z) to index units (x, y, z) """
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    return np.linalg.inv(direction @ np.diag(image.GetSpacing())).astype(np.float32)
+
+
+def compute_slab_errors(forward_slab, inverse, to_index, z, yx_grid):
+    """
+    return the inverse consistency error for each voxel of forward_slab,
+    which starts at slice z of the forward warp.
+    """
+    # displacement in index units, components are (x, y, z)
+    index_displacement = forward_slab @ to_index.T
+    z_grid = np.arange(z, z + forward_slab.shape[0], dtype=np.float32)
+    coords = np.stack([z_grid[:, np.newaxis, np.newaxis] + index_displacement[..., 2],
+                       yx_grid[0] + index_displacement[..., 1],
+                       yx_grid[1] + index_displacement[..., 0]], axis=-1)
+    return np.linalg.norm(forward_slab + trilinear_interpolate(inverse, coords), axis=-1)
+
+
+def compute_inverse_consistency_errors(forward_warp, inverse_warp, mask=None, slab_size=8):
+    """
+    return the inverse consistency error (physical units, likely mm)
+    for each voxel of the warp (inside the mask if given) as a 1D array.
+
+    forward_warp, inverse_warp - SimpleITK displacement field images on the same grid.
+    mask - optional SimpleITK image on the same grid. Only voxels > 0 are included.
+    slab_size - number of z slices composed at once.
+    """
+    for attr in ['GetSize', 'GetOrigin', 'GetSpacing', 'GetDirection']:
+        if getattr(forward_warp, attr)() != getattr(inverse_warp, attr)():
+            raise Exception('forward and inverse warps are not defined on the same grid')
+    forward = sitk.GetArrayViewFromImage(forward_warp)  # (z, y, x, 3)
+    inverse = sitk.GetArrayViewFromImage(inverse_warp)
+    mask_array = sitk.GetArrayViewFromImage(mask) if mask is not None else None
+    to_index = get_physical_to_index_matrix(forward_warp)
+    yx_grid = np.meshgrid(np.arange(forward.shape[1], dtype=np.float32),
+                          np.arange(forward.shape[2], dtype=np.float32), indexing='ij')
+    errors = []
+    for z in range(0, forward.shape[0], slab_size):
+        slab_errors = compute_slab_errors(forward[z:z+slab_size], inverse, to_index, z, yx_grid)
+        if mask_array is not None:
+            slab_errors = slab_errors[mask_array[z:z+slab_size] > 0]
+        errors.append(slab_errors.ravel())
+    return np.concatenate(errors)
+
+
+def compute_inverse_consistency_for_fraction(fraction_path, mask_path, slab_size):
+    """ return (mean, 95th percentile, max) inverse consistency error for one fraction """
+    start_time = time.time()
+    forward_warp = sitk.ReadImage(os.path.join(fraction_path, 'registered1Warp.nii.gz'),
+                                  sitk.sitkVectorFloat32)
+    inverse_warp = sitk.ReadImage(os.path.join(fraction_path, 'registered1InverseWarp.nii.gz'),
+                                  sitk.sitkVectorFloat32)
+    mask = None
+    if mask_path:
+        # resample onto the warp grid, which may differ from the struct
+        # grid, for example if the registration used cropped scans.
+        mask = sitk.Resample(sitk.ReadImage(mask_path, sitk.sitkFloat32) >= 0.5, forward_warp,
+                             sitk.Transform(), sitk.sitkNearestNeighbor, 0, sitk.sitkUInt8)
+    errors = compute_inverse_consistency_errors(forward_warp, inverse_warp, mask, slab_size)
+    if not errors.size:
+        raise Exception(f'No voxels inside the mask {mask_path} for {fraction_path}')
+    print(f'time for {fraction_path}: {time.time() - start_time} seconds')
+    return np.mean(errors), np.percentile(errors, 95), np.max(errors)
+
+
+def store_inverse_consistency_for_fraction(results_db_path, parameters, patient,
+                                           patient_path, fraction_dir, mask_path, slab_size):
+    """ compute the errors for one fraction and upsert them into the results store """
+    mean_error, p95_error, max_error = compute_inverse_consistency_for_fraction(
+        os.path.join(patient_path, fraction_dir), mask_path, slab_size)
+    print(f"{patient},{fraction_dir},mean:{mean_error},"
+          f"p95:{p95_error},max:{max_error}")
+    upsert_results(results_db_path, STAGE, parameters,
+                   [(patient, fraction_dir, {'mean_error': mean_error,
+                                             'p95_error': p95_error,
+                                             'max_error': max_error})])
+
+
+def compute_inverse_consistency_for_all_patients(in_dir, planning_dir_name, mask_file_name,
+                                                 patient_dir, results_db_path, slab_size,
+                                                 cpus=2, output_csv_path=None, recompute=False):
+    """
+        in_dir  - directory containing all the patient folders.
+        planning_dir_name - folder containing the fixed image.
+        mask_file_name - optional struct in the planning dir. If given then
+                         errors are only computed inside the struct.
+        cpus - number of fractions processed at once. Each process holds both
+               warps (and the errors) for one fraction in memory.
+    """
+    patient_dirs = os.listdir(in_dir)
+    if patient_dir:
+        patient_dirs = [patient_dir]
+        print('Running on', patient_dirs, 'only')
+
+    parameters = get_parameters_key(input_dir=os.path.abspath(in_dir),
+                                    planning_dir_name=planning_dir_name,
+                                    mask_file_name=mask_file_name)
+    completed = set()
+    if not recompute:
+        completed = get_completed_keys(results_db_path, STAGE, parameters)
+
+    # each worker writes its own result, so a failed fraction does not lose the others.
+    with Pool(cpus) as pool:
+        async_results = []
+        for patient in patient_dirs:
+            async_results += start_patient_fractions(pool, in_dir, patient, planning_dir_name,
+                                                     mask_file_name, completed,
+                                                     (results_db_path, parameters, slab_size))
+        pool.close()
+        pool.join()
+    report_failures(async_results)
+
+    if output_csv_path:
+        export_csv(results_db_path, STAGE, output_csv_path, parameters)
+
+
+def start_patient_fractions(pool, in_dir, patient, planning_dir_name, mask_file_name,
+                            completed, store_args):
+    """
+    start computing the fractions of the patient that are not in completed.
+    store_args - (results_db_path, parameters, slab_size)
+    return a list of (patient, fraction_dir, async result)
+    """
+    results_db_path, parameters, slab_size = store_args
+    patient_path = os.path.join(in_dir, patient)
+    mask_path = None
+    if mask_file_name:
+        mask_path = os.path.join(patient_path, planning_dir_name, mask_file_name)
+    return [(patient, fraction_dir,
+             pool.apply_async(store_inverse_consistency_for_fraction,
+                              args=[results_db_path, parameters, patient, patient_path,
+                                    fraction_dir, mask_path, slab_size]))
+            for fraction_dir in get_missing_fractions(patient_path, patient,
+                                                      planning_dir_name, completed)]
+
+
+def report_failures(async_results):
+    failed = 0
+    for patient, fraction_dir, res in async_results:
+        try:
+            res.get()
+        except Exception as error:  # pylint: disable=broad-except
+            failed += 1
+            print(f'inverse consistency for {patient},{fraction_dir} failed: {error}')
+    print(f'{failed} of {len(async_results)} fractions failed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description="Compute inverse consistency error of the deformable transforms",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("input", help="Directory containing patient folders (nifty files)")
+    parser.add_argument("plan_dir", help="Name of directory containing the "
+                                         "planning scan (fixed image)")
+    parser.add_argument("--mask-file-name", type=str, required=False,
+                        help="Struct in plan_dir. If given, errors are computed inside it only")
+    parser.add_argument("--slab-size", type=int, default=8,
+                        help="Number of z slices composed at once")
+    parser.add_argument("--cpus", type=int, default=2,
+                        help="Number of fractions processed in parallel. Each needs memory for "
+                             "both full warps, so increase with care")
+    parser.add_argument("--patient-dir", type=str, required=False,
+                        help="patient to process (useful for testing)")
+    parser.add_argument("--results-db", type=str, default='results.db',
+                        help="Path of results database (created if it does not exist)")
+    parser.add_argument("--output-csv", type=str, required=False,
+                        help="Path of output csv file, exported from the results database")
+    parser.add_argument("--recompute", action=argparse.BooleanOptionalAction,
+                        help="Recompute results already in the results database")
+    args = parser.parse_args()
+    config = vars(args)
+    print(config)
+    compute_inverse_consistency_for_all_patients(config['input'],
+                                                 config['plan_dir'],
+                                                 config['mask_file_name'],
+                                                 config['patient_dir'],
+                                                 config['results_db'],
+                                                 config['slab_size'],
+                                                 config['cpus'],
+                                                 config['output_csv'],
+                                                 config['recompute'])
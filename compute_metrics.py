@@ -21,44 +21,76 @@ from medpy import metric
 import numpy as np
 import nibabel as nib
 
+from results_store import (get_parameters_key, get_completed_keys, get_missing_fractions,
+                           upsert_results, export_csv)
+
+STAGE = 'metrics'
+
 
 def compute_metrics_for_all_patients(input_dir,
                                      struct_file_name,
                                      planning_dir_name,
                                      transformed_struct_file_name,
                                      patient_dir,
-                                     output_csv_path):
+                                     results_db_path,
+                                     output_csv_path=None,
+                                     recompute=False):
 
     patient_dirs = os.listdir(input_dir)
     if patient_dir:
         patient_dirs = [patient_dir]
 
-    with open(output_csv_path, 'w+', encoding='utf-8') as metrics_file:
-        print("patient,fraction,dice,hd95,precision,recall", file=metrics_file)
-        for patient in patient_dirs:
-            patient_path = os.path.join(input_dir, patient)
-            fraction_dirs = [d for d in os.listdir(patient_path) if d != planning_dir_name]
-
-            fixed_struct_path = os.path.join(patient_path,
-                                             planning_dir_name,
-                                             struct_file_name)
-
-            fixed_struct = nib.load(fixed_struct_path).get_fdata()
-            assert (a := np.min(fixed_struct)) == 0, a
-            assert (a := np.max(fixed_struct)) == 1.0, a
-            fixed_struct[fixed_struct < 0.5] = 0
-            fixed_struct[fixed_struct >= 0.5] = 1
-
-            for fraction_dir in fraction_dirs:
-                compute_metrics_for_fraction(metrics_file, 
-                                             fixed_struct,
-                                             patient_path,
-                                             patient,
-                                             fraction_dir,
-                                             transformed_struct_file_name)
-
-def compute_metrics_for_fraction(metrics_file,
-                                 fixed_struct,
+    parameters = get_parameters_key(input_dir=os.path.abspath(input_dir),
+                                    fixed_struct_file_name=struct_file_name,
+                                    planning_dir_name=planning_dir_name,
+                                    transformed_struct_file_name=transformed_struct_file_name)
+    completed = set()
+    if not recompute:
+        completed = get_completed_keys(results_db_path, STAGE, parameters)
+
+    for patient in patient_dirs:
+        patient_path = os.path.join(input_dir, patient)
+        fraction_dirs = get_missing_fractions(patient_path, patient,
+                                              planning_dir_name, completed)
+        if fraction_dirs:
+            rows = compute_metrics_for_patient(patient_path, patient, fraction_dirs,
+                                               struct_file_name, planning_dir_name,
+                                               transformed_struct_file_name)
+            # one batched write per patient
+            upsert_results(results_db_path, STAGE, parameters, rows)
+
+    if output_csv_path:
+        export_csv(results_db_path, STAGE, output_csv_path, parameters)
+
+
+def compute_metrics_for_patient(patient_path,
+                                patient,
+                                fraction_dirs,
+                                struct_file_name,
+                                planning_dir_name,
+                                transformed_struct_file_name):
+    fixed_struct_path = os.path.join(patient_path,
+                                     planning_dir_name,
+                                     struct_file_name)
+
+    fixed_struct = nib.load(fixed_struct_path).get_fdata()
+    assert (a := np.min(fixed_struct)) == 0, a
+    assert (a := np.max(fixed_struct)) == 1.0, a
+    fixed_struct[fixed_struct < 0.5] = 0
+    fixed_struct[fixed_struct >= 0.5] = 1
+
+    rows = []
+    for fraction_dir in fraction_dirs:
+        metrics = compute_metrics_for_fraction(fixed_struct,
+                                               patient_path,
+                                               patient,
+                                               fraction_dir,
+                                               transformed_struct_file_name)
+        rows.append((patient, fraction_dir, metrics))
+    return rows
+
+
+def compute_metrics_for_fraction(fixed_struct,
                                  patient_path,
                                  patient,
                                  fraction_dir,
@@ -78,8 +110,7 @@ def compute_metrics_for_fraction(metrics_file,
 
     print(f"{patient},{fraction_dir},dice:{dice},"
           f"hd95:{hd},prec:{precision},recall:{recall}")
-    print(f"{patient},{fraction_dir},{dice},"
-          f"{hd},{precision},{recall}", file=metrics_file)
+    return {'dice': dice, 'hd95': hd, 'precision': precision, 'recall': recall}
 
 
 if __name__ == '__main__':
@@ -97,8 +128,12 @@ if __name__ == '__main__':
     parser.add_argument("--patient-dir", type=str, required=False,
                         help="patient to process (useful for testing)")
 
-    parser.add_argument("--output-csv", type=str, required=True,
-                        help="Path of output csv file")
+    parser.add_argument("--results-db", type=str, default='results.db',
+                        help="Path of results database (created if it does not exist)")
+    parser.add_argument("--output-csv", type=str, required=False,
+                        help="Path of output csv file, exported from the results database")
+    parser.add_argument("--recompute", action=argparse.BooleanOptionalAction,
+                        help="Recompute results already in the results database")
 
     args = parser.parse_args()
     config = vars(args)
@@ -108,4 +143,6 @@ if __name__ == '__main__':
         config['plan_dir'],
         config['transformed_struct_file_name'],
         config['patient_dir'],
-        config['output_csv'])
+        config['results_db'],
+        config['output_csv'],
+        config['recompute'])
@@ -17,40 +17,71 @@ import argparse
 from medpy import metric
 import nibabel as nib
 
+from results_store import (get_parameters_key, get_completed_keys, get_missing_fractions,
+                           upsert_results, export_csv)
+
+STAGE = 'mutual_information'
+
 
 def compute_mi_for_all_patients(input_dir,
                                 planning_dir_name,
                                 fixed_scan_name,
                                 transformed_scan_name,
                                 patient_dir,
-                                output_csv_path):
+                                results_db_path,
+                                output_csv_path=None,
+                                recompute=False):
 
     patient_dirs = os.listdir(input_dir)
     if patient_dir:
         patient_dirs = [patient_dir]
 
-    with open(output_csv_path, 'w+', encoding='utf-8') as metrics_file:
-        print("patient,fraction,mutual_information", file=metrics_file)
-        for patient in patient_dirs:
-            patient_path = os.path.join(input_dir, patient)
-            fraction_dirs = [d for d in os.listdir(patient_path) if d != planning_dir_name]
+    parameters = get_parameters_key(input_dir=os.path.abspath(input_dir),
+                                    fixed_scan_name=fixed_scan_name,
+                                    planning_dir_name=planning_dir_name,
+                                    transformed_scan_name=transformed_scan_name)
+    completed = set()
+    if not recompute:
+        completed = get_completed_keys(results_db_path, STAGE, parameters)
+
+    for patient in patient_dirs:
+        patient_path = os.path.join(input_dir, patient)
+        fraction_dirs = get_missing_fractions(patient_path, patient,
+                                              planning_dir_name, completed)
+        if fraction_dirs:
+            rows = compute_mi_for_patient(patient_path, patient, fraction_dirs,
+                                          planning_dir_name, fixed_scan_name,
+                                          transformed_scan_name)
+            # one batched write per patient
+            upsert_results(results_db_path, STAGE, parameters, rows)
+
+    if output_csv_path:
+        export_csv(results_db_path, STAGE, output_csv_path, parameters)
+
 
-            fixed_scan_path = os.path.join(patient_path,
-                                           planning_dir_name,
-                                           fixed_scan_name)
+def compute_mi_for_patient(patient_path,
+                           patient,
+                           fraction_dirs,
+                           planning_dir_name,
+                           fixed_scan_name,
+                           transformed_scan_name):
+    fixed_scan_path = os.path.join(patient_path,
+                                   planning_dir_name,
+                                   fixed_scan_name)
 
-            fixed_scan = nib.load(fixed_scan_path).get_fdata()
+    fixed_scan = nib.load(fixed_scan_path).get_fdata()
 
-            for fraction_dir in fraction_dirs:
-                compute_mi_for_fraction(metrics_file, 
-                                        fixed_scan,
-                                        patient_path,
-                                        patient,
-                                        fraction_dir,
-                                        transformed_scan_name)
+    rows = []
+    for fraction_dir in fraction_dirs:
+        mutual_information = compute_mi_for_fraction(fixed_scan,
+                                                     patient_path,
+                                                     patient,
+                                                     fraction_dir,
+                                                     transformed_scan_name)
+        rows.append((patient, fraction_dir, {'mutual_information': mutual_information}))
+    return rows
 
-def compute_mi_for_fraction(metrics_file,
-                            fixed_scan,
+def compute_mi_for_fraction(fixed_scan,
                             patient_path,
                             patient,
                             fraction_dir,
@@ -61,7 +92,7 @@ def compute_mi_for_fraction(metrics_file,
     transformed_scan = nib.load(fraction_scan_path).get_fdata()
     mutual_information = metric.image.mutual_information(fixed_scan, transformed_scan)
     print(f"{patient},{fraction_dir},mutual_information:{mutual_information}")
-    print(f"{patient},{fraction_dir},{mutual_information}", file=metrics_file)
+    return mutual_information
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -76,8 +107,12 @@ if __name__ == '__main__':
         help="File name of transformed scans (assumed to be the same accross fractions).")
     parser.add_argument("--patient-dir", type=str, required=False,
                         help="patient to process (useful for testing)")
-    parser.add_argument("--output-csv", type=str, required=True,
-                        help="Path of output csv file")
+    parser.add_argument("--results-db", type=str, default='results.db',
+                        help="Path of results database (created if it does not exist)")
+    parser.add_argument("--output-csv", type=str, required=False,
+                        help="Path of output csv file, exported from the results database")
+    parser.add_argument("--recompute", action=argparse.BooleanOptionalAction,
+                        help="Recompute results already in the results database")
 
     args = parser.parse_args()
     config = vars(args)
@@ -87,4 +122,6 @@ if __name__ == '__main__':
         config['fixed_scan_name'],
         config['transformed_scan_name'],
         config['patient_dir'],
-        config['output_csv'])
+        config['results_db'],
+        config['output_csv'],
+        config['recompute'])
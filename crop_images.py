@@ -0,0 +1,159 @@
+"""
+Copyright (C) 2022 Abraham George Smith
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Crop (and optionally downsample) scans to the body before registration.
+
+The scans produced by convert_dicom_to_nifty.py include large air margins
+and the couch. SyN pays for every voxel, so registering a crop around the
+body is much faster. The cropped images keep their position in physical
+space (the crop offset is stored in the image origin), which means the
+transforms computed on them still apply to the full size dose and struct.
+"""
+
+import os
+import argparse
+import SimpleITK as sitk
+
+
+def get_body_mask(image, threshold=None):
+    """
+    Threshold the image and keep the largest connected component.
+
+    image - SimpleITK image (scan)
+    threshold - intensity above which a voxel is considered part of the body.
+                If None then Otsu's method is used to pick the threshold.
+    """
+    if threshold is None:
+        otsu_filter = sitk.OtsuThresholdImageFilter()
+        otsu_filter.Execute(image)
+        threshold = otsu_filter.GetThreshold()
+    mask = image > threshold
+    # an opening helps to detach the couch from the body when they touch.
+    mask = sitk.BinaryMorphologicalOpening(mask, [2, 2, 2])
+    components = sitk.RelabelComponent(sitk.ConnectedComponent(mask),
+                                       sortByObjectSize=True)
+    return components == 1
+
+
+def get_body_bounding_box(image, threshold=None, margin=10.0):
+    """
+    return (index, size) of the body bounding box in voxels.
+
+    image - SimpleITK image (scan)
+    threshold - see get_body_mask
+    margin - distance (in physical units) added around the body on each side.
+             Clipped to the image extent. The images written by
+             convert_dicom_to_nifty.py have unit spacing, so this is in voxels.
+    """
+    body_mask = get_body_mask(image, threshold)
+    shape_stats = sitk.LabelShapeStatisticsImageFilter()
+    shape_stats.Execute(body_mask)
+    if not shape_stats.HasLabel(1):
+        raise Exception('Could not find the body in the image. '
+                        'Try specifying a lower threshold.')
+    bbox = shape_stats.GetBoundingBox(1)
+    dims = image.GetDimension()
+    lower = bbox[:dims]
+    upper = [l + s for l, s in zip(lower, bbox[dims:])]
+    margin_voxels = [int(round(margin / s)) for s in image.GetSpacing()]
+    lower = [max(0, l - m) for l, m in zip(lower, margin_voxels)]
+    upper = [min(n, u + m) for u, m, n in zip(upper, margin_voxels, image.GetSize())]
+    size = [u - l for l, u in zip(lower, upper)]
+    return lower, size
+
+
+def crop_image(image, index, size, shrink_factor=1):
+    """
+    Crop the image to the region given by index and size and optionally
+    downsample it by an integer shrink_factor (averaging voxels).
+    The origin of the returned image is updated so that it
+    still occupies the same position in physical space.
+    """
+    cropped = sitk.RegionOfInterest(image, size=size, index=index)
+    if shrink_factor > 1:
+        cropped = sitk.BinShrink(cropped, [shrink_factor] * cropped.GetDimension())
+    return cropped
+
+
+def crop_image_file(image_path, output_path, threshold=None, margin=10.0, shrink_factor=1):
+    """ crop the image at image_path to the body and save to output_path """
+    image = sitk.ReadImage(image_path, sitk.sitkFloat32)
+    index, size = get_body_bounding_box(image, threshold, margin)
+    cropped = crop_image(image, index, size, shrink_factor)
+    print(f'cropping {image_path} from {image.GetSize()} to {cropped.GetSize()}'
+          f' (offset {index}), saving to {output_path}')
+    sitk.WriteImage(cropped, output_path)
+    return output_path
+
+
+def get_cropped_file_name(scan_name):
+    return scan_name.replace('.nii.gz', '') + '_cropped.nii.gz'
+
+
+def crop_scan_for_registration(scan_dir, scan_name, crop_options):
+    """
+    crop scan_dir/scan_name and return the path of the cropped scan.
+    crop_options - dict of threshold, margin and shrink_factor (see crop_image_file)
+    """
+    return crop_image_file(os.path.join(scan_dir, scan_name),
+                           os.path.join(scan_dir, get_cropped_file_name(scan_name)),
+                           **crop_options)
+
+
+def crop_all_patients(in_dir, scan_name, threshold, margin, shrink_factor, patient_dir):
+    """
+        in_dir - directory containing all the patient folders.
+        scan_name - name of the scan file in each fraction (and planning) directory.
+        threshold - body threshold (None to use Otsu's method).
+        margin - margin added around the body (physical units, voxels for the
+                 unit spacing images written by convert_dicom_to_nifty.py).
+        shrink_factor - integer downsampling factor applied after cropping.
+    """
+    patient_dirs = os.listdir(in_dir)
+    if patient_dir:
+        patient_dirs = [patient_dir]
+        print('Running on', patient_dirs, 'only')
+
+    for patient in patient_dirs:
+        patient_path = os.path.join(in_dir, patient)
+        for fraction_dir in os.listdir(patient_path):
+            fraction_path = os.path.join(patient_path, fraction_dir)
+            crop_scan_for_registration(fraction_path, scan_name,
+                                       {'threshold': threshold, 'margin': margin,
+                                        'shrink_factor': shrink_factor})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description="Crop (and optionally downsample) scans to the body",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("input", help="Directory containing patient folders (nifty files)")
+    parser.add_argument("scan_name", help="Name of the scan files that will be cropped,"
+                                          " assumed same for all fractions.")
+    parser.add_argument("--threshold", type=float, required=False,
+                        help="Body intensity threshold. Otsu's method is used if not given")
+    parser.add_argument("--margin", type=float, default=10.0,
+                        help="Margin added around the body bounding box in physical units "
+                             "(voxels for scans from convert_dicom_to_nifty.py, "
+                             "which have unit spacing)")
+    parser.add_argument("--shrink-factor", type=int, default=1,
+                        help="Integer downsampling factor applied after cropping")
+    parser.add_argument("--patient-dir", type=str, required=False,
+                        help="patient to process (useful for testing)")
+    args = parser.parse_args()
+    config = vars(args)
+    print(config)
+    crop_all_patients(config['input'], config['scan_name'], config['threshold'],
+                      config['margin'], config['shrink_factor'], config['patient_dir'])
@@ -0,0 +1,262 @@
+"""
+Copyright (C) 2022 Abraham George Smith
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Compute voxelwise statistics (mean, standard deviation and percentiles)
+over many dose volumes, such as the per-fraction deviation from the planned
+dose. The volumes are never all loaded at once and nothing is written to disk
+apart from the results. The image is split into blocks of slices (along the
+last axis, which is contiguous in the nifty file) and, for each block, only
+that block of each volume is read, one volume at a time.
+Mean and variance are computed with Welford's algorithm and percentiles are
+estimated from a fixed size random sample (reservoir) of values per voxel,
+so memory use does not grow with the number of volumes.
+Blocks are processed in parallel.
+
+Uncompressed (.nii) volumes are read directly. For .nii.gz volumes each block
+decompresses the file up to the end of that block, so larger blocks mean fewer
+passes over the files (but more memory). If indexed_gzip is installed, nibabel
+uses it to seek in .nii.gz files without decompressing them from the start.
+
+Statistics can be computed per patient (over the fractions in that patient's
+planning frame) or over the whole cohort when the volumes have already been
+mapped to a common reference patient. Over the cohort, the volume can also be
+taken from each patient's planning dir, such as the summed dose from sum_doses.py.
+"""
+
+import os
+from multiprocessing import Pool
+import argparse
+import time
+
+import numpy as np
+import nibabel as nib
+
+
+def load_block(path, block_start, block_end):
+    """ load slices block_start:block_end (last axis) as a writable float32 array """
+    return np.array(nib.load(path).dataobj[..., block_start:block_end], dtype=np.float32)
+
+
+def load_deviation_block(volume_path, reference_path, references, block_start, block_end):
+    """
+    load the block of the volume minus the block of the reference (if any).
+    references - dict of reference_path -> block, so each reference is read once per block.
+    """
+    block = load_block(volume_path, block_start, block_end)
+    if reference_path:
+        if reference_path not in references:
+            references[reference_path] = load_block(reference_path, block_start, block_end)
+        block -= references[reference_path]
+    return block
+
+
+def update_block_statistics(statistics, block, n, rng):
+    """ add the n'th block (counting from 1) to the running statistics """
+    # Welford's online mean and variance
+    delta = block - statistics['mean']
+    statistics['mean'] += delta / n
+    statistics['sum_sq_diff'] += delta * (block - statistics['mean'])
+
+    # reservoir sampling, each voxel keeps a uniform random sample of its values.
+    sample = statistics['sample']
+    if n <= sample.shape[-1]:
+        sample[..., n - 1] = block
+    else:
+        slots = rng.integers(0, n, size=block.shape)
+        replace = slots < sample.shape[-1]
+        sample[replace, slots[replace]] = block[replace]
+
+
+def compute_block_statistics(volume_pairs, block_start, block_end,
+                             percentiles, sample_size, seed):
+    """
+    Stream over the volumes and return the mean, std and percentile values
+    for one block of slices, stacked along the first axis.
+
+    volume_pairs - see compute_population_statistics.
+    sample_size - number of values kept per voxel to estimate the percentiles.
+                  The percentiles are exact when there are no more volumes than this.
+    """
+    rng = np.random.default_rng(seed)
+    shape = nib.load(volume_pairs[0][0]).shape[:-1] + (block_end - block_start,)
+    statistics = {'mean': np.zeros(shape, dtype=np.float64),
+                  'sum_sq_diff': np.zeros(shape, dtype=np.float64),
+                  'sample': np.zeros(shape + (sample_size,), dtype=np.float32)}
+    references = {}
+    for n, (volume_path, reference_path) in enumerate(volume_pairs, start=1):
+        update_block_statistics(statistics, load_deviation_block(volume_path, reference_path,
+                                                                 references, block_start,
+                                                                 block_end), n, rng)
+    sample = statistics['sample'][..., :min(len(volume_pairs), sample_size)]
+    return np.concatenate([statistics['mean'][np.newaxis],
+                           np.sqrt(statistics['sum_sq_diff'] / len(volume_pairs))[np.newaxis],
+                           np.percentile(sample, percentiles, axis=-1)]).astype(np.float32)
+
+
+def check_shapes(volume_pairs, shape):
+    for volume_path, reference_path in volume_pairs:
+        for path in [volume_path, reference_path]:
+            if path and nib.load(path).shape != shape:
+                raise Exception(f'{path} has shape {nib.load(path).shape} but expected '
+                                f'{shape}. Are all volumes in the same (reference) frame?')
+
+
+def compute_all_block_statistics(pool, volume_pairs, shape, percentiles,
+                                 block_size, sample_size):
+    """ return the mean, std and percentile images stacked along the first axis """
+    statistics = np.zeros((2 + len(percentiles),) + shape, dtype=np.float32)
+    async_results = []
+    for block_start in range(0, shape[-1], block_size):
+        block_end = min(block_start + block_size, shape[-1])
+        res = pool.apply_async(compute_block_statistics,
+                               args=[volume_pairs, block_start, block_end,
+                                     percentiles, sample_size, block_start])
+        async_results.append((block_start, block_end, res))
+    for block_start, block_end, res in async_results:
+        statistics[..., block_start:block_end] = res.get()
+    return statistics
+
+
+def compute_population_statistics(volume_pairs, output_prefix, percentiles,
+                                  block_size, sample_size, cpus=os.cpu_count()):
+    """
+    Compute voxelwise statistics over the volumes and save them as
+    {output_prefix}_mean.nii.gz, {output_prefix}_std.nii.gz and
+    {output_prefix}_p{percentile}.nii.gz
+
+    volume_pairs - list of (volume_path, reference_path). reference_path
+                   may be None, otherwise it is subtracted from the volume.
+    block_size - number of slices in each block. Memory use per process is
+                 roughly block voxels * (sample_size + 5) * 4 bytes.
+    """
+    assert volume_pairs, 'No volumes found to compute statistics'
+    start = time.time()
+    first_image = nib.load(volume_pairs[0][0])
+    check_shapes(volume_pairs, first_image.shape)
+
+    with Pool(cpus) as pool:
+        statistics = compute_all_block_statistics(pool, volume_pairs, first_image.shape,
+                                                  percentiles, block_size, sample_size)
+
+    names = ['mean', 'std'] + [f'p{p:g}' for p in percentiles]
+    for name, image in zip(names, statistics):
+        out_path = f'{output_prefix}_{name}.nii.gz'
+        print('saving', out_path)
+        nib.Nifti1Image(image, first_image.affine).to_filename(out_path)
+    print(f'statistics over {len(volume_pairs)} volumes took {time.time() - start} seconds')
+
+
+def get_volume_pairs(patient_path, planning_dir_name, volume_file_name,
+                     reference_file_name, volume_in_plan_dir=False):
+    """
+    return (volume_path, reference_path) for each fraction, or for the
+    planning dir only if volume_in_plan_dir (such as the output of sum_doses.py)
+    """
+    reference_path = None
+    if reference_file_name:
+        reference_path = os.path.join(patient_path, planning_dir_name, reference_file_name)
+    if volume_in_plan_dir:
+        volume_dirs = [planning_dir_name]
+    else:
+        volume_dirs = [d for d in os.listdir(patient_path) if d != planning_dir_name]
+    return [(os.path.join(patient_path, volume_dir, volume_file_name), reference_path)
+            for volume_dir in volume_dirs]
+
+
+def compute_statistics_for_all_patients(in_dir, planning_dir_name, volume_file_name,
+                                        reference_file_name, per_patient, output_prefix,
+                                        percentiles, block_size, sample_size, patient_dir,
+                                        volume_in_plan_dir=False):
+    """
+        in_dir  - directory containing all the patient folders.
+        planning_dir_name - folder containing the fixed image.
+        volume_file_name - name of the fraction volumes, for example the transformed dose.
+        reference_file_name - optional volume in the planning dir (such as the planned dose)
+                              that is subtracted from each fraction volume.
+        per_patient - if True, compute statistics over each patient's fractions and
+                      save them in the planning dir with output_prefix as the file name prefix.
+                      Otherwise compute over all fractions of all patients (these must be mapped
+                      to a common reference patient) and save with output_prefix as the path prefix.
+        volume_in_plan_dir - use the volume in the planning dir of each patient (such as
+                             the summed dose from sum_doses.py) instead of the fraction volumes.
+                             Only useful over the whole cohort.
+    """
+    if per_patient and volume_in_plan_dir:
+        raise Exception('Per patient statistics need the fraction volumes, '
+                        'there is only one volume in the planning dir.')
+    patient_dirs = os.listdir(in_dir)
+    if patient_dir:
+        patient_dirs = [patient_dir]
+        print('Running on', patient_dirs, 'only')
+
+    if per_patient:
+        for patient in patient_dirs:
+            patient_path = os.path.join(in_dir, patient)
+            compute_population_statistics(
+                get_volume_pairs(patient_path, planning_dir_name,
+                                 volume_file_name, reference_file_name),
+                os.path.join(patient_path, planning_dir_name, output_prefix),
+                percentiles, block_size, sample_size)
+    else:
+        volume_pairs = []
+        for patient in patient_dirs:
+            volume_pairs += get_volume_pairs(os.path.join(in_dir, patient), planning_dir_name,
+                                             volume_file_name, reference_file_name,
+                                             volume_in_plan_dir)
+        compute_population_statistics(volume_pairs, output_prefix,
+                                      percentiles, block_size, sample_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description="Compute voxelwise statistics over fraction volumes",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("input", help="Directory containing patient folders (nifty files)")
+    parser.add_argument("plan_dir", help="Name of directory containing the "
+                                         "planning scan (fixed image)")
+    parser.add_argument("volume_file_name",
+                        help="Name of the fraction volumes (e.g. transformed dose),"
+                             " assumed same for all fractions.")
+    parser.add_argument("--reference-file-name", type=str, required=False,
+                        help="Name of volume in plan_dir (e.g. planned dose) subtracted from "
+                             "each fraction volume, to give statistics of the deviation")
+    parser.add_argument("--per-patient", action=argparse.BooleanOptionalAction,
+                        help="Compute statistics for each patient in their planning frame "
+                             "instead of over the whole cohort")
+    parser.add_argument("--output-prefix", type=str, required=True,
+                        help="Output path prefix (cohort) or file name prefix saved in "
+                             "plan_dir (per patient)")
+    parser.add_argument("--percentiles", type=float, nargs='+', default=[5, 50, 95],
+                        help="Percentiles to compute")
+    parser.add_argument("--block-size", type=int, default=4,
+                        help="Number of slices processed by each process at once. Larger blocks "
+                             "use more memory but read compressed volumes fewer times")
+    parser.add_argument("--sample-size", type=int, default=64,
+                        help="Number of values kept per voxel to estimate percentiles")
+    parser.add_argument("--volume-in-plan-dir", action=argparse.BooleanOptionalAction,
+                        help="Use the volume in plan_dir of each patient (e.g. the summed dose)"
+                             " instead of the fraction volumes")
+    parser.add_argument("--patient-dir", type=str, required=False,
+                        help="patient to process (useful for testing)")
+    args = parser.parse_args()
+    config = vars(args)
+    print(config)
+    compute_statistics_for_all_patients(config['input'], config['plan_dir'],
+                                        config['volume_file_name'],
+                                        config['reference_file_name'],
+                                        config['per_patient'], config['output_prefix'],
+                                        config['percentiles'], config['block_size'],
+                                        config['sample_size'], config['patient_dir'],
+                                        config['volume_in_plan_dir'])
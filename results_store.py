@@ -0,0 +1,157 @@
+"""
+Copyright (C) 2022 Abraham George Smith
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Store results (such as the metrics from compute_metrics.py) in an SQLite
+database, keyed by patient, fraction, stage and parameters.
+
+Writes are batched and upserted, so partial reruns update the existing
+results instead of overwriting them and many processes can write to the
+same database. Later runs can look up which keys are already computed
+and only compute the missing ones. Results can be exported to csv.
+"""
+
+import os
+import argparse
+import csv
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    patient TEXT NOT NULL,
+    fraction TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (patient, fraction, stage, parameters, metric)
+)
+"""
+
+# cohort wide queries select by stage and parameters.
+INDEX = "CREATE INDEX IF NOT EXISTS results_stage ON results (stage, parameters)"
+
+
+def get_parameters_key(**parameters):
+    """
+    stable text key for the parameters used to compute a result.
+    Callers include the absolute input directory, so results computed from
+    different output trees (for example cropped and uncropped registrations)
+    are kept apart.
+    """
+    return json.dumps(parameters, sort_keys=True)
+
+
+def connect(db_path):
+    # the timeout makes writers wait for each other instead of failing.
+    connection = sqlite3.connect(db_path, timeout=60)
+    # write ahead logging allows reading while another process is writing.
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(SCHEMA)
+    connection.execute(INDEX)
+    return connection
+
+
+def upsert_results(db_path, stage, parameters, rows):
+    """
+    Insert or update results in a single transaction.
+
+    rows - list of (patient, fraction, metrics) where metrics is a dict of
+           metric name -> value.
+    """
+    # numpy scalars (such as np.float32) would otherwise be stored as blobs.
+    records = [(patient, fraction, stage, parameters, metric,
+                None if value is None else float(value))
+               for patient, fraction, metrics in rows
+               for metric, value in metrics.items()]
+    connection = connect(db_path)
+    try:
+        with connection:
+            connection.executemany(
+                'INSERT INTO results (patient, fraction, stage, parameters, metric, value) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (patient, fraction, stage, parameters, metric) '
+                'DO UPDATE SET value = excluded.value', records)
+    finally:
+        connection.close()
+
+
+def get_completed_keys(db_path, stage, parameters):
+    """ return the set of (patient, fraction) that already have results """
+    connection = connect(db_path)
+    try:
+        return set(connection.execute(
+            'SELECT DISTINCT patient, fraction FROM results '
+            'WHERE stage = ? AND parameters = ?', (stage, parameters)))
+    finally:
+        connection.close()
+
+
+def get_missing_fractions(patient_path, patient, planning_dir_name, completed):
+    """ return the fraction dirs of the patient without results in completed """
+    return [d for d in os.listdir(patient_path) if d != planning_dir_name
+            and (patient, d) not in completed]
+
+
+def get_results(db_path, stage, parameters=None):
+    """
+    return (metric names, rows) with one row of
+    [patient, fraction, parameters, values...] per key.
+    Metrics are ordered by when they were first stored.
+    """
+    where = 'WHERE stage = ?'
+    query_args = [stage]
+    if parameters is not None:
+        where += ' AND parameters = ?'
+        query_args.append(parameters)
+    connection = connect(db_path)
+    try:
+        metrics = [m for (m,) in connection.execute(
+            f'SELECT metric FROM results {where} GROUP BY metric ORDER BY MIN(rowid)', query_args)]
+        rows = {}
+        for patient, fraction, params, metric, value in connection.execute(
+                'SELECT patient, fraction, parameters, metric, value '
+                f'FROM results {where} ORDER BY patient, fraction', query_args):
+            row = rows.setdefault((patient, fraction, params), [None] * len(metrics))
+            row[metrics.index(metric)] = value
+    finally:
+        connection.close()
+    return metrics, [list(key) + values for key, values in rows.items()]
+
+
+def export_csv(db_path, stage, output_csv_path, parameters=None):
+    """ write one row per patient and fraction, with a column for each metric """
+    metrics, rows = get_results(db_path, stage, parameters)
+    include_parameters = parameters is None
+    with open(output_csv_path, 'w+', encoding='utf-8', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        header = ['patient', 'fraction'] + (['parameters'] if include_parameters else [])
+        writer.writerow(header + metrics)
+        for patient, fraction, params, *values in rows:
+            writer.writerow([patient, fraction] + ([params] if include_parameters else [])
+                            + values)
+    print('Exported', len(rows), stage, 'results to', output_csv_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description="Export results from the results database to csv",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("results_db", help="Path of results database")
+    parser.add_argument("stage", help="Stage to export, for example metrics or mutual_information")
+    parser.add_argument("--output-csv", type=str, required=True,
+                        help="Path of output csv file")
+    args = parser.parse_args()
+    config = vars(args)
+    export_csv(config['results_db'], config['stage'], config['output_csv'])
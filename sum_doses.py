@@ -14,18 +14,166 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 Take the transformed doses that have already been created by 
 transform_dose.py and sum them for each patient.
+
+The sum can be physical dose or biologically effective dose (BED or EQD2),
+with alpha/beta varying per voxel through a structure label map.
 """
 
 import os
 import argparse
+import json
+import numpy as np
 import SimpleITK as sitk
 
 
+def get_inverse_alpha_beta_lookup(alpha_beta_labels, alpha_beta_values, default_alpha_beta):
+    """
+    return an array mapping each label in alpha_beta_labels to 1 / (alpha/beta).
+    If there is no label map (alpha_beta_labels is None) then return the
+    scalar 1 / default_alpha_beta, so no per voxel volume is needed.
+
+    alpha_beta_labels - numpy array of integer structure labels (planning frame)
+    alpha_beta_values - dict of label -> alpha/beta (Gy)
+    default_alpha_beta - alpha/beta (Gy) for labels not in alpha_beta_values
+    """
+    if alpha_beta_labels is None:
+        return np.float32(1 / default_alpha_beta)
+    max_label = max([int(alpha_beta_labels.max())] + list(alpha_beta_values.keys()))
+    lookup = np.full(max_label + 1, 1 / default_alpha_beta, dtype=np.float32)
+    for label, alpha_beta in alpha_beta_values.items():
+        lookup[label] = 1 / alpha_beta
+    return lookup
+
+
+def get_inverse_alpha_beta_slab(inverse_alpha_beta, alpha_beta_labels, z, slab_size):
+    """ 1 / (alpha/beta) for slices z:z+slab_size, a scalar if there is no label map """
+    if alpha_beta_labels is None:
+        return inverse_alpha_beta
+    return inverse_alpha_beta[alpha_beta_labels[z:z+slab_size]]
+
+
+def add_bed_slabs(bed_sum, fraction_dose, inverse_alpha_beta, alpha_beta_labels, slab_size):
+    """
+    Add the biologically effective dose of one fraction to bed_sum (in place).
+
+    BED = d * (1 + d / (alpha/beta)) where d is the (voxelwise) dose of the fraction.
+    Computed in z-slabs so the only temporaries are slab sized.
+    """
+    for z in range(0, bed_sum.shape[0], slab_size):
+        dose_slab = fraction_dose[z:z+slab_size]
+        bed_slab = dose_slab * get_inverse_alpha_beta_slab(inverse_alpha_beta,
+                                                           alpha_beta_labels, z, slab_size)
+        bed_slab += 1
+        bed_slab *= dose_slab
+        bed_sum[z:z+slab_size] += bed_slab
+
+
+def bed_to_eqd2_slabs(bed_sum, inverse_alpha_beta, alpha_beta_labels, slab_size):
+    """ EQD2 = BED / (1 + 2 / (alpha/beta)), converted in place in z-slabs """
+    for z in range(0, bed_sum.shape[0], slab_size):
+        bed_sum[z:z+slab_size] /= 1 + 2 * get_inverse_alpha_beta_slab(
+            inverse_alpha_beta, alpha_beta_labels, z, slab_size)
+
+
+def sum_physical_doses(dose_paths):
+    dose_sum = sitk.ReadImage(dose_paths[0], sitk.sitkFloat32)
+    for dose_path in dose_paths[1:]:
+        dose_sum += sitk.ReadImage(dose_path, sitk.sitkFloat32)
+    return dose_sum
+
+
+def read_alpha_beta_labels(alpha_beta_labels_path, shape):
+    """ return the label map as a numpy array, checking it matches the dose shape """
+    alpha_beta_labels = sitk.GetArrayFromImage(
+        sitk.ReadImage(alpha_beta_labels_path, sitk.sitkUInt16))
+    if alpha_beta_labels.shape != shape:
+        raise Exception(f'alpha/beta label map {alpha_beta_labels_path} has shape '
+                        f'{alpha_beta_labels.shape} but the dose has shape {shape}')
+    return alpha_beta_labels
+
+
+def sum_biological_doses(dose_paths, dose_quantity, alpha_beta_labels_path,
+                         alpha_beta_values, default_alpha_beta, slab_size):
+    """
+    Sum the doses as BED or EQD2 (dose_quantity), with alpha/beta
+    assigned per voxel from the label map at alpha_beta_labels_path.
+
+    The fraction doses are read one at a time and accumulated in float32,
+    so memory use is the same as for summing physical dose.
+    """
+    # only the header of the first dose is read for the geometry, so that
+    # at most the sum and one fraction dose are in memory.
+    dose_info = sitk.ImageFileReader()
+    dose_info.SetFileName(dose_paths[0])
+    dose_info.ReadImageInformation()
+    bed_sum = np.zeros(dose_info.GetSize()[::-1], dtype=np.float32)
+
+    alpha_beta_labels = None
+    if alpha_beta_labels_path:
+        alpha_beta_labels = read_alpha_beta_labels(alpha_beta_labels_path, bed_sum.shape)
+    inverse_alpha_beta = get_inverse_alpha_beta_lookup(alpha_beta_labels, alpha_beta_values,
+                                                       default_alpha_beta)
+
+    for dose_path in dose_paths:
+        fraction_dose = sitk.ReadImage(dose_path, sitk.sitkFloat32)
+        add_bed_slabs(bed_sum, sitk.GetArrayViewFromImage(fraction_dose),
+                      inverse_alpha_beta, alpha_beta_labels, slab_size)
+        del fraction_dose
+
+    if dose_quantity == 'eqd2':
+        bed_to_eqd2_slabs(bed_sum, inverse_alpha_beta, alpha_beta_labels, slab_size)
+    del alpha_beta_labels
+
+    dose_sum = sitk.GetImageFromArray(bed_sum)
+    del bed_sum
+    dose_sum.SetOrigin(dose_info.GetOrigin())
+    dose_sum.SetSpacing(dose_info.GetSpacing())
+    dose_sum.SetDirection(dose_info.GetDirection())
+    return dose_sum
+
+
+def check_alpha_beta_options(dose_quantity, alpha_beta_options):
+    """ raise if the alpha/beta options would be ignored or are invalid """
+    if dose_quantity == 'physical':
+        if alpha_beta_options.get('labels_file_name') or alpha_beta_options.get('values'):
+            raise Exception('alpha/beta labels and values are only used for '
+                            'bed or eqd2 dose quantity, not physical')
+        return
+    if alpha_beta_options.get('values') and not alpha_beta_options.get('labels_file_name'):
+        raise Exception('alpha/beta values for labels require an alpha/beta label map')
+    if alpha_beta_options.get('default', 10.0) <= 0:
+        raise Exception('The default alpha/beta must be greater than 0')
+
+
+def get_patient_dose_paths(patient_path, planning_dir_name, plan_dose_file_name,
+                           transformed_dose_file_name):
+    """ plan dose followed by the transformed dose of each fraction """
+    fraction_dirs = [d for d in os.listdir(patient_path) if d != planning_dir_name]
+    return [os.path.join(patient_path, planning_dir_name, plan_dose_file_name)] + [
+        os.path.join(patient_path, fraction_dir, transformed_dose_file_name)
+        for fraction_dir in fraction_dirs]
+
+
+def sum_patient_doses(dose_paths, planning_path, dose_quantity, alpha_beta_options, slab_size):
+    if dose_quantity == 'physical':
+        return sum_physical_doses(dose_paths)
+    alpha_beta_labels_path = None
+    if alpha_beta_options.get('labels_file_name'):
+        alpha_beta_labels_path = os.path.join(planning_path,
+                                              alpha_beta_options['labels_file_name'])
+    return sum_biological_doses(dose_paths, dose_quantity, alpha_beta_labels_path,
+                                alpha_beta_options.get('values') or {},
+                                alpha_beta_options.get('default', 10.0), slab_size)
+
+
 def sum_doses_for_all_patients(in_dir, planning_dir_name,
                                plan_dose_file_name,
                                transformed_dose_file_name,
                                patient_dir,
-                               summed_dose_file_name):
+                               summed_dose_file_name,
+                               dose_quantity='physical',
+                               alpha_beta_options=None,
+                               slab_size=16):
     """
         in_dir  - directory containing all the patient folders.
         planning_dir_name - folder containing the fixed image.
@@ -33,28 +181,131 @@ def sum_doses_for_all_patients(in_dir, planning_dir_name,
                          same for all fractions (and the planning scan),
                          with unique details being stored in the folder names.
         first_n - used to restrict processing for testing/debugging.
+        dose_quantity - 'physical', 'bed' or 'eqd2'.
+        alpha_beta_options - dict used for bed and eqd2 with
+            labels_file_name - name of a label map in the planning dir
+                               used to assign alpha/beta per voxel.
+            values - dict of label -> alpha/beta (Gy). Requires labels_file_name.
+            default - alpha/beta (Gy) for voxels with other labels (default 10).
+        slab_size - number of z slices processed at once for BED/EQD2.
     """
+    alpha_beta_options = alpha_beta_options or {}
+    check_alpha_beta_options(dose_quantity, alpha_beta_options)
     patient_dirs = os.listdir(in_dir)
     if patient_dir:
         patient_dirs = [patient_dir]
         print('Running on', patient_dirs, 'only')
 
     for patient in patient_dirs:
-        patient_path = os.path.join(in_dir, patient)
-        fraction_dirs = [d for d in os.listdir(patient_path) if d != planning_dir_name]
-        plan_dose_path = os.path.join(patient_path, planning_dir_name, plan_dose_file_name)
+        planning_path = os.path.join(in_dir, patient, planning_dir_name)
+        dose_paths = get_patient_dose_paths(os.path.join(in_dir, patient), planning_dir_name,
+                                            plan_dose_file_name, transformed_dose_file_name)
+        dose_sum = sum_patient_doses(dose_paths, planning_path, dose_quantity,
+                                     alpha_beta_options, slab_size)
+
+        # save the summed dose in the planning dir name
+        summed_dose_path = os.path.join(planning_path, summed_dose_file_name)
+        print('Saving summed dose to', summed_dose_path)
+        sitk.WriteImage(dose_sum, summed_dose_path)
+
+
+def parse_alpha_beta_values(alpha_beta_args):
+    """ convert ['1:3', '2:10'] to {1: 3.0, 2: 10.0} """
+    alpha_beta_values = {}
+    for alpha_beta_arg in alpha_beta_args or []:
+        try:
+            label, alpha_beta = alpha_beta_arg.split(':')
+            label, alpha_beta = int(label), float(alpha_beta)
+        except ValueError as error:
+            raise Exception(f'alpha/beta {alpha_beta_arg} should be label:value, '
+                            'for example 1:3') from error
+        # negative labels would index the lookup from the end.
+        if label < 0 or alpha_beta <= 0:
+            raise Exception(f'alpha/beta {alpha_beta_arg} needs a label >= 0 '
+                            'and a value > 0')
+        alpha_beta_values[label] = alpha_beta
+    return alpha_beta_values
+
+
+def add_fraction_to_dose_sum(plan_dose_path, fraction_dose_path, summed_dose_path,
+                             fraction_name):
+    """
+    Add a single transformed fraction dose to a persisted running dose sum.
+    If the running sum does not exist yet it is started from the plan dose,
+    matching sum_doses_for_all_patients. Only the running sum and the new
+    fraction dose are read, so the previous fractions are not re-summed.
+
+    fraction_name - name of the fraction directory, recorded in a ledger
+                    next to the running sum (see get_accumulated_fractions).
+
+    The new sum is written to a temporary file and the ledger records it as
+    pending before the sum is replaced. If we are interrupted at any point,
+    recover_dose_sum either completes or discards the update, so a fraction
+    is never counted twice or recorded without being added.
+    """
+    accumulated = get_accumulated_fractions(summed_dose_path)
+    if fraction_name in accumulated:
+        raise Exception(f'{fraction_name} has already been added to {summed_dose_path}')
+    if os.path.isfile(summed_dose_path):
+        dose_sum = sitk.ReadImage(summed_dose_path, sitk.sitkFloat32)
+    else:
         dose_sum = sitk.ReadImage(plan_dose_path, sitk.sitkFloat32)
-        for fraction_dir in fraction_dirs:
-            fraction_dose_path = os.path.join(patient_path, fraction_dir,
-                                              transformed_dose_file_name)
-            dose_sum += sitk.ReadImage(fraction_dose_path, sitk.sitkFloat32)
+    dose_sum += sitk.ReadImage(fraction_dose_path, sitk.sitkFloat32)
+
+    tmp_path = get_tmp_dose_sum_path(summed_dose_path)
+    sitk.WriteImage(dose_sum, tmp_path)
+    write_ledger(summed_dose_path, accumulated + [fraction_name], pending=True)
+    os.replace(tmp_path, summed_dose_path)
+    write_ledger(summed_dose_path, accumulated + [fraction_name], pending=False)
+    print('Added', fraction_dose_path, 'to running dose sum', summed_dose_path)
+
+
+def get_tmp_dose_sum_path(summed_dose_path):
+    return summed_dose_path.replace('.nii.gz', '_tmp.nii.gz')
+
+
+def get_ledger_path(summed_dose_path):
+    return summed_dose_path.replace('.nii.gz', '_fractions.json')
+
+
+def write_ledger(summed_dose_path, fractions, pending):
+    """ atomically replace the ledger of fractions added to the running dose sum """
+    ledger_path = get_ledger_path(summed_dose_path)
+    tmp_path = ledger_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'fractions': fractions, 'pending': pending}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ledger_path)
+
+
+def recover_dose_sum(summed_dose_path):
+    """
+    Complete an update of the running dose sum that was interrupted after
+    the ledger recorded it as pending. If the temporary sum still exists it
+    was not moved into place yet, so it is moved now. Otherwise it was.
+    A temporary sum without a pending ledger entry is discarded.
+    """
+    ledger_path = get_ledger_path(summed_dose_path)
+    tmp_path = get_tmp_dose_sum_path(summed_dose_path)
+    ledger = {'fractions': [], 'pending': False}
+    if os.path.isfile(ledger_path):
+        with open(ledger_path, encoding='utf-8') as f:
+            ledger = json.load(f)
+    if ledger['pending']:
+        if os.path.isfile(tmp_path):
+            os.replace(tmp_path, summed_dose_path)
+        write_ledger(summed_dose_path, ledger['fractions'], pending=False)
+    elif os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    return ledger['fractions']
+
+
+def get_accumulated_fractions(summed_dose_path):
+    """ return the names of the fractions already added to the running dose sum """
+    return recover_dose_sum(summed_dose_path)
 
-    # save the summed dose in the planning dir name
-    summed_dose_path = os.path.join(patient_path, planning_dir_name, summed_dose_file_name)
-    print('Saving summed dose to', summed_dose_path)
-    sitk.WriteImage(dose_sum, summed_dose_path)
 
-            
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
                 description="Sum transformed dose files",
@@ -72,6 +323,19 @@ if __name__ == '__main__':
                         help="patient to process (useful for testing)")
     parser.add_argument("--output-name", type=str, required=True,
                         help="Name of output summed dose file. Saved in plan_dir")
+    parser.add_argument("--dose-quantity", type=str, default='physical',
+                        choices=['physical', 'bed', 'eqd2'],
+                        help="Sum physical dose or biologically effective dose (BED/EQD2)")
+    parser.add_argument("--alpha-beta-labels", type=str, required=False,
+                        help="Name of label map in plan_dir used to assign alpha/beta "
+                             "per voxel. If not given, the default alpha/beta is used.")
+    parser.add_argument("--alpha-beta", type=str, nargs='+', required=False,
+                        help="alpha/beta (Gy) for labels in the label map as label:value,"
+                             " for example 1:3 2:10. Requires --alpha-beta-labels")
+    parser.add_argument("--default-alpha-beta", type=float, default=10.0,
+                        help="alpha/beta (Gy) for voxels with a label not given in --alpha-beta")
+    parser.add_argument("--slab-size", type=int, default=16,
+                        help="Number of z slices processed at once for BED/EQD2")
 
     args = parser.parse_args()
     config = vars(args)
@@ -81,4 +345,9 @@ if __name__ == '__main__':
                                config['plan_dose_file_name'],
                                config['transformed_dose_file_name'],
                                config['patient_dir'],
-                               config['output_name'])
+                               config['output_name'],
+                               config['dose_quantity'],
+                               {'labels_file_name': config['alpha_beta_labels'],
+                                'values': parse_alpha_beta_values(config['alpha_beta']),
+                                'default': config['default_alpha_beta']},
+                               config['slab_size'])
@@ -25,7 +25,9 @@ import time
 def transform_moving_image_to_fixed_image(moving_image_dir_path,
                                           moving_image_file_name,
                                           planning_dir_name,
-                                          fixed_image_path):
+                                          fixed_image_path,
+                                          transform_prefix='registered',
+                                          output_path=None):
     """
     Transforms for one fraction
 
@@ -33,26 +35,34 @@ def transform_moving_image_to_fixed_image(moving_image_dir_path,
     moving_image_file_name - name of the moving_image file (assumed consistent for all fractions)
     fixed_image_path - full path to the fixed image. likely a 
                        reference scan used for computing the registration.
+    transform_prefix - output prefix that was given to antsRegistrationSyN.sh
+    output_path - where to save the transformed image. By default this is
+                  derived from the moving image and planning dir names.
+
+    Returns the output path and the exit status of antsApplyTransforms.
     """
 
     start_time = time.time()
-    output_path = os.path.join(moving_image_dir_path, 
-        f'{os.path.basename(moving_image_file_name.replace(".nii.gz", ""))}'
-        f'_transformed_to_{planning_dir_name}.nii.gz')
+    if output_path is None:
+        output_path = os.path.join(moving_image_dir_path,
+            f'{os.path.basename(moving_image_file_name.replace(".nii.gz", ""))}'
+            f'_transformed_to_{planning_dir_name}.nii.gz')
 
     moving_image_path = os.path.join(moving_image_dir_path, moving_image_file_name)
     
     # tranforms moving image to fixed image
-    deformable_transform = os.path.join(moving_image_dir_path, 'registered1Warp.nii.gz')
-    affine_transform = os.path.join(moving_image_dir_path, 'registered0GenericAffine.mat')
+    deformable_transform = os.path.join(moving_image_dir_path, f'{transform_prefix}1Warp.nii.gz')
+    affine_transform = os.path.join(moving_image_dir_path,
+                                    f'{transform_prefix}0GenericAffine.mat')
 
     cmd = (f'antsApplyTransforms -d 3 -i {moving_image_path} '
            f'-o {output_path} -r {fixed_image_path} '
            f'-t {deformable_transform} -t {affine_transform}')
 
     print(cmd)
-    os.system(cmd)
+    exit_status = os.system(cmd)
     print(f'time for {moving_image_dir_path}: {time.time() - start_time} seconds')
+    return output_path, exit_status
 
 
 def transform_moving_images_to_fixed_images(in_dir, planning_dir_name,
@@ -0,0 +1,259 @@
+"""
+Copyright (C) 2022 Abraham George Smith
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Online mode for adaptive treatment, where fractions arrive daily.
+
+Watch a folder of dicom patient directories (same layout as used by
+convert_dicom_to_nifty.py). When a new fraction directory is complete
+(its files have stopped changing for the settle time) it is converted,
+registered to the planning scan, its dose is transformed and then added
+to a running dose sum stored in the planning directory.
+Only the new fraction is processed. Earlier fractions are not re-read.
+If a fraction (or the planning scan) fails, the error is saved to
+failed.txt in its output directory and the other fractions continue to
+be processed. Delete failed.txt to retry it.
+"""
+
+import os
+import argparse
+import time
+import traceback
+
+from convert_dicom_to_nifty import convert_fraction_to_nifty
+from compute_ants_registrations import register_fraction
+from transform_image import transform_moving_image_to_fixed_image
+from sum_doses import add_fraction_to_dose_sum, get_accumulated_fractions
+
+# file names created by convert_dicom_to_nifty.py
+SCAN_NAME = 'scan.nii.gz'
+DOSE_NAME = 'dose.nii.gz'
+STRUCT_NAME = 'struct.nii.gz'
+# written to the fraction output directory when processing fails
+FAILED_NAME = 'failed.txt'
+
+
+def get_dir_signature(dicom_dir):
+    """ file count, total size and latest modification time of the files in dicom_dir """
+    file_count = 0
+    total_size = 0
+    latest_mtime = 0
+    for f in os.listdir(dicom_dir):
+        fpath = os.path.join(dicom_dir, f)
+        if os.path.isfile(fpath):
+            stat = os.stat(fpath)
+            file_count += 1
+            total_size += stat.st_size
+            latest_mtime = max(latest_mtime, stat.st_mtime)
+    return file_count, total_size, latest_mtime
+
+
+class FractionWatcher:
+    """
+    Keep track of when each dicom directory last changed so we only
+    process directories that have finished being exported.
+    """
+    def __init__(self, settle_time):
+        self.settle_time = settle_time
+        self.signatures = {}  # dicom dir -> (signature, time signature was first seen)
+
+    def is_complete(self, dicom_dir):
+        signature = get_dir_signature(dicom_dir)
+        now = time.time()
+        previous = self.signatures.get(dicom_dir)
+        if previous is None or previous[0] != signature:
+            self.signatures[dicom_dir] = (signature, now)
+            return False
+        # empty directories are still waiting for the export to start.
+        return signature[0] > 0 and now - previous[1] >= self.settle_time
+
+
+def process_fraction(dicom_fraction_path, patient_out_path, planning_dir_name,
+                     struct_name, summed_dose_file_name):
+    """
+    convert -> register -> transform -> accumulate for a single (new) fraction.
+    """
+    start_time = time.time()
+    fraction_dir = os.path.basename(dicom_fraction_path).replace(' ', '_')
+    fraction_path = os.path.join(patient_out_path, fraction_dir)
+    planning_path = os.path.join(patient_out_path, planning_dir_name)
+    planning_scan_path = os.path.join(planning_path, SCAN_NAME)
+
+    convert_fraction_to_nifty(dicom_fraction_path, fraction_path, struct_name)
+
+    # if we were restarted after the registration finished then don't repeat it.
+    warp_path = os.path.join(fraction_path, 'registered1Warp.nii.gz')
+    if not os.path.isfile(warp_path):
+        exit_status = register_fraction(planning_scan_path,
+                                        os.path.join(fraction_path, SCAN_NAME),
+                                        os.path.join(fraction_path, 'registered'))
+        check_output(exit_status, warp_path, 'antsRegistrationSyN.sh')
+
+    transformed_paths = {}
+    for image_name in [DOSE_NAME, STRUCT_NAME]:
+        transformed_paths[image_name], exit_status = transform_moving_image_to_fixed_image(
+            moving_image_dir_path=fraction_path,
+            moving_image_file_name=image_name,
+            planning_dir_name=planning_dir_name,
+            fixed_image_path=planning_scan_path)
+        check_output(exit_status, transformed_paths[image_name], 'antsApplyTransforms')
+
+    add_fraction_to_dose_sum(os.path.join(planning_path, DOSE_NAME),
+                             transformed_paths[DOSE_NAME],
+                             os.path.join(planning_path, summed_dose_file_name),
+                             fraction_dir)
+    print(f'time for {dicom_fraction_path}: {time.time() - start_time} seconds')
+
+
+def check_output(exit_status, output_path, cmd_name):
+    if exit_status != 0 or not os.path.isfile(output_path):
+        raise Exception(f'{cmd_name} failed (exit status {exit_status}), '
+                        f'expected output {output_path}')
+
+
+def get_failed_path(fraction_out_path):
+    return os.path.join(fraction_out_path, FAILED_NAME)
+
+
+def record_failure(dicom_path, out_path):
+    """ save the current exception to failed.txt in out_path so it is not retried """
+    error = traceback.format_exc()
+    os.makedirs(out_path, exist_ok=True)
+    with open(get_failed_path(out_path), 'w', encoding='utf-8') as f:
+        print(error, file=f)
+    print(f'processing {dicom_path} failed, see {get_failed_path(out_path)}\n{error}')
+
+
+def is_planning_ready(watcher, patient_path, patient_out_path, planning_dicom_dir,
+                      struct_name):
+    """
+    convert the planning scan once its dicom directory is complete.
+    If conversion fails it is recorded like a failed fraction and not retried
+    until failed.txt is deleted from the planning output directory.
+    """
+    planning_out_path = os.path.join(patient_out_path, os.path.basename(
+        planning_dicom_dir).replace(' ', '_'))
+    if os.path.isfile(os.path.join(planning_out_path, DOSE_NAME)):
+        return True
+    dicom_planning_path = os.path.join(patient_path, planning_dicom_dir)
+    if (os.path.isfile(get_failed_path(planning_out_path))
+            or not watcher.is_complete(dicom_planning_path)):
+        return False
+    try:
+        convert_fraction_to_nifty(dicom_planning_path, planning_out_path, struct_name)
+    except Exception:  # pylint: disable=broad-except
+        record_failure(dicom_planning_path, planning_out_path)
+        return False
+    return True
+
+
+def try_process_fraction(dicom_fraction_path, patient_out_path, planning_dir_name,
+                         struct_name, summed_dose_file_name):
+    """
+    Process the fraction. If this fails, the error is written to a file in
+    the fraction output directory and the fraction is not retried until that
+    file is deleted, so one bad fraction does not stop the others.
+    """
+    try:
+        process_fraction(dicom_fraction_path, patient_out_path, planning_dir_name,
+                         struct_name, summed_dose_file_name)
+    except Exception:  # pylint: disable=broad-except
+        record_failure(dicom_fraction_path, os.path.join(
+            patient_out_path, os.path.basename(dicom_fraction_path).replace(' ', '_')))
+
+
+def get_sub_dirs(path):
+    """ sorted directories in path, skipping stray files such as .DS_Store """
+    return sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+
+
+def process_complete_patient_fractions(watcher, patient_path, patient_out_path,
+                                       planning_dir_name, struct_name, summed_dose_file_name):
+    fraction_dirs = get_sub_dirs(patient_path)
+    planning_dirs = [d for d in fraction_dirs if d.replace(' ', '_') == planning_dir_name]
+    # fractions can't be registered until the planning scan arrives.
+    if not planning_dirs or not is_planning_ready(watcher, patient_path, patient_out_path,
+                                                  planning_dirs[0], struct_name):
+        return
+
+    accumulated = get_accumulated_fractions(
+        os.path.join(patient_out_path, planning_dir_name, summed_dose_file_name))
+    for fraction_dir in fraction_dirs:
+        fraction_out_dir = fraction_dir.replace(' ', '_')
+        if (fraction_dir in planning_dirs or fraction_out_dir in accumulated
+                or os.path.isfile(get_failed_path(
+                    os.path.join(patient_out_path, fraction_out_dir)))):
+            continue
+        dicom_fraction_path = os.path.join(patient_path, fraction_dir)
+        if watcher.is_complete(dicom_fraction_path):
+            try_process_fraction(dicom_fraction_path, patient_out_path, planning_dir_name,
+                                 struct_name, summed_dose_file_name)
+
+
+def process_complete_fractions(watcher, in_dir, out_dir, planning_dir_name,
+                               struct_name, summed_dose_file_name):
+    for patient in get_sub_dirs(in_dir):
+        try:
+            process_complete_patient_fractions(watcher, os.path.join(in_dir, patient),
+                                               os.path.join(out_dir, patient),
+                                               planning_dir_name, struct_name,
+                                               summed_dose_file_name)
+        except Exception:  # pylint: disable=broad-except
+            # for example the output directory could not be written.
+            # try again on the next poll rather than stopping the watch.
+            print(f'processing patient {patient} failed\n{traceback.format_exc()}')
+
+
+def watch_for_fractions(in_dir, out_dir, planning_dir_name, struct_name,
+                        summed_dose_file_name, settle_time, poll_interval):
+    """
+        in_dir - directory containing the dicom patient folders (watched).
+        out_dir - output location for the nifty files.
+        planning_dir_name - folder containing the planning scan.
+        struct_name - name of structure to convert.
+        summed_dose_file_name - name of the running dose sum, saved in the planning dir.
+        settle_time - seconds a fraction directory must remain unchanged
+                      before it is considered completely exported.
+        poll_interval - seconds between checks of in_dir.
+    """
+    watcher = FractionWatcher(settle_time)
+    print('Watching', in_dir, 'for new fractions')
+    while True:
+        process_complete_fractions(watcher, in_dir, out_dir, planning_dir_name,
+                                   struct_name, summed_dose_file_name)
+        time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description="Watch for new fractions and update the accumulated dose",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("input", help="Directory containing patient folders (dicom files)")
+    parser.add_argument("output", help="Output location for nifty files")
+    parser.add_argument("plan_dir", help="Name of directory containing the "
+                                         "planning scan (fixed image)")
+    parser.add_argument("--struct-name", type=str, required=True, help="name of structure")
+    parser.add_argument("--output-name", type=str, required=True,
+                        help="Name of running summed dose file. Saved in plan_dir")
+    parser.add_argument("--settle-time", type=float, default=60,
+                        help="Seconds a fraction directory must be unchanged "
+                             "before it is processed")
+    parser.add_argument("--poll-interval", type=float, default=10,
+                        help="Seconds between checks for new fractions")
+    args = parser.parse_args()
+    config = vars(args)
+    print(config)
+    watch_for_fractions(config['input'], config['output'], config['plan_dir'],
+                        config['struct_name'], config['output_name'],
+                        config['settle_time'], config['poll_interval'])